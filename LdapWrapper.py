@@ -1,57 +1,140 @@
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from itertools import islice
 from time import time
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Tuple
+from dataclasses import dataclass, InitVar
+from typing import Optional, List, Dict, Tuple, Set, FrozenSet
 import ldap
+from ldap.controls import SimplePagedResultsControl
 from ldap.filter import escape_filter_chars
 
+# Attributes read for a user (Users cache) and for a person (People sync)
+USER_ATTRS = ('uid', 'cn', 'givenname', 'sn', 'memberof', 'telegramnickname', 'telegramid', 'nsaccountlock')
+PERSON_ATTRS = ('uid', 'cn', 'telegramnickname', 'telegramid')
+# Search filters, values must be escaped before interpolation
+FILTER_PEOPLE = "(objectClass=weeeOpenPerson)"
+FILTER_USER_BY_TGID = "(&(objectClass=weeeOpenPerson)(telegramId=%d))"
+FILTER_USER_BY_NICKNAME = "(&(objectClass=weeeOpenPerson)(!(telegramId=*))(telegramNickname=%s))"
+FILTER_INVITE_BY_TGID = "(&(inviteCode=*)(telegramId=%d))"
+FILTER_INVITE_BY_CODE = "(inviteCode=%s)"
+
+logger = logging.getLogger(__name__)
+
 
 class LdapConnection:
-    def __init__(self, server: str, bind_dn: str, password: str):
+    def __init__(self, server: str, bind_dn: str, password: str, pool_size: int = 2):
         self.bind_dn = bind_dn
         self.password = password
         self.server = server
+        # Bound connections are kept here and reused, None is an empty slot that will be connected on demand
+        self.__pool = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self.__pool.put((None, 0))
+        # Connections currently handed out, per thread, so concurrent "with" blocks don't step on each other
+        self.__local = threading.local()
 
     def __enter__(self):
-        print("Connecting to LDAP")
-        self.conn = ldap.initialize(f"ldap://{self.server}:389")
-        self.conn.protocol_version = ldap.VERSION3
-        self.conn.start_tls_s()
-        self.conn.simple_bind_s(self.bind_dn, self.password)
-        if self.conn is None:
-            raise LdapConnectionError
-        return self.conn
+        try:
+            conn, last_used = self.__pool.get(timeout=30)
+        except queue.Empty:
+            raise LdapConnectionError("No LDAP connection available in pool")
+
+        try:
+            if conn is not None and time() - last_used > 60 and not LdapConnection.__is_alive(conn):
+                conn = None
+            if conn is None:
+                conn = self.__connect()
+        except BaseException:
+            # Give the slot back, or the pool would shrink forever
+            self.__pool.put((None, 0))
+            raise
+
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        self.__local.stack.append(conn)
+        return conn
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        print("Disconnecting from LDAP")
-        self.conn.unbind_s()
+        conn = self.__local.stack.pop()
+        if exc_type is not None and issubclass(exc_type, ldap.LDAPError):
+            # Connection may be broken, don't give it to anyone else
+            logger.info("Discarding LDAP connection")
+            LdapConnection.__close(conn)
+            self.__pool.put((None, 0))
+        else:
+            self.__pool.put((conn, time()))
+
+    def __connect(self):
+        logger.info("Connecting to LDAP")
+        conn = ldap.initialize(f"ldap://{self.server}:389")
+        conn.protocol_version = ldap.VERSION3
+        conn.start_tls_s()
+        conn.simple_bind_s(self.bind_dn, self.password)
+        if conn is None:
+            raise LdapConnectionError
+        return conn
 
+    @staticmethod
+    def __is_alive(conn) -> bool:
+        try:
+            conn.whoami_s()
+            return True
+        except ldap.LDAPError:
+            logger.info("Stale LDAP connection, reconnecting")
+            LdapConnection.__close(conn)
+            return False
 
-class LdapConnectionError(BaseException):
+    @staticmethod
+    def __close(conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+class LdapConnectionError(Exception):
     pass
 
 
-class DuplicateEntryError(BaseException):
+class DuplicateEntryError(Exception):
     pass
 
 
-class AccountLockedError(BaseException):
+class AccountLockedError(Exception):
     pass
 
 
-class AccountNotFoundError(BaseException):
+class AccountNotFoundError(Exception):
     pass
 
 
-class AccountNotCompletedError(BaseException):
+class AccountNotCompletedError(Exception):
     def __init__(self, invite_code: str, *args):
         super().__init__(*args)
         self.invite_code = invite_code
 
 
 class Users:
-    def __init__(self, admin_groups: List[str], tree: str, invite_tree: str):
-        self.__users: Dict[int, User] = {}
+    def __init__(self, admin_groups: List[str], tree: str, invite_tree: str, max_size: int = 1000, ttl: int = 3600,
+                 unknown_ttl: int = 300):
+        # Least recently used first
+        self.__users: Dict[int, User] = OrderedDict()
+        # Telegram IDs not found on LDAP => when we looked for them, so spamming the bot doesn't hammer LDAP
+        self.__unknown: Dict[int, float] = OrderedDict()
+        self.unknown_ttl = unknown_ttl
+        self.__accesses = 0
+        # Telegram ID => event set when whoever is looking it up on LDAP is done
+        self.__inflight: Dict[int, threading.Event] = {}
+        # Held for every read and write of the dicts above (and moving entries around), but never while talking to LDAP
+        self.__lock = threading.Lock()
+        self.max_size = max_size
+        self.ttl = ttl
         self.admin_groups = admin_groups
+        # memberof values are bytes, encode once here rather than decoding every one of them. Lowercase as bytes, like
+        # memberof values, since str.lower() would also fold non-ASCII letters and then they would never match.
+        self.admin_groups_b = frozenset(group.encode().lower() for group in admin_groups or ())
         self.tree = tree
         self.invite_tree = invite_tree
 
@@ -59,34 +142,80 @@ class Users:
         if not isinstance(tgid, int):
             raise IndexError(f"{tgid} is not an int")
 
-        user = None
-        # Try to get cached user
-        if tgid in self.__users:
-            user = self.__users[tgid]
-            if not user.need_update():
-                return user
+        with self.__lock:
+            unknown_since = self.__unknown.get(tgid)
+            if unknown_since is not None:
+                if time() - unknown_since < self.unknown_ttl:
+                    raise AccountNotFoundError()
+                self.__unknown.pop(tgid, None)
+
+            self.__accesses += 1
+            if self.__accesses % 64 == 0:
+                self.__sweep()
+
+            # Try to get cached user
+            user = self.__users.get(tgid)
+            if user is not None:
+                self.__users.move_to_end(tgid)
+                if not user.need_update():
+                    return user
+
+            # Somebody else is already asking LDAP for this user? Wait for them, then try the cache again
+            searching = self.__inflight.get(tgid)
+            if searching is None:
+                self.__inflight[tgid] = threading.Event()
+        if searching is not None:
+            searching.wait()
+            return self.get(tgid, nickname, conn)
 
+        try:
+            return self.__load(tgid, user, nickname, conn)
+        finally:
+            with self.__lock:
+                self.__inflight.pop(tgid).set()
+
+    def __load(self, tgid: int, user, nickname: Optional[str], conn: LdapConnection):
+        # Stale and missing users share the same connection
         with conn as c:
             # Got it but it's stale?
             if user is not None:
                 try:
-                    if user.need_update():
-                        user.update(c, self.admin_groups, True, nickname)
+                    user.update(c, self.admin_groups_b, True, nickname, self.ttl)
                 except (AccountNotFoundError, AccountLockedError, DuplicateEntryError):
-                    del self.__users[tgid]
+                    with self.__lock:
+                        self.__users.pop(tgid, None)
                     user = None
 
             # Deleted stale user or didn't get it?
             if user is None:
-                user = User.search(tgid, nickname, self.admin_groups, c, self.tree, self.invite_tree)
-                self.__users[tgid] = user
+                try:
+                    user = User.search(tgid, nickname, self.admin_groups_b, c, self.tree, self.invite_tree, self.ttl)
+                except AccountNotFoundError:
+                    with self.__lock:
+                        self.__unknown[tgid] = time()
+                        if len(self.__unknown) > 1024:
+                            self.__unknown.popitem(last=False)
+                    raise
+                with self.__lock:
+                    self.__users[tgid] = user
+                    if len(self.__users) > self.max_size:
+                        self.__users.popitem(last=False)
 
         return user
 
+    def __sweep(self):
+        """
+        Drop expired users among the least recently used ones, a few at a time. Call with the lock held.
+        """
+        for tgid in list(islice(self.__users, 32)):
+            if self.__users[tgid].need_update():
+                del self.__users[tgid]
+
     def update_invite(self, invite_code: str, tgid: int, nickname: Optional[str], conn: LdapConnection):
         invite_code_escaped = escape_filter_chars(invite_code)
+        tgid_b = str(tgid).encode('ascii')
         with conn as c:
-            result = c.search_s(self.invite_tree, ldap.SCOPE_SUBTREE, f"(inviteCode={invite_code_escaped})", ())
+            result = c.search_s(self.invite_tree, ldap.SCOPE_SUBTREE, FILTER_INVITE_BY_CODE % invite_code_escaped, ())
 
             if len(result) == 0:
                 raise AccountNotFoundError()
@@ -94,29 +223,43 @@ class Users:
                 raise DuplicateEntryError(f"Invite code {invite_code} associated to {len(result)} invites")
 
             dn = result[0][0]
-            del result
 
-            modlist = [(ldap.MOD_REPLACE, 'telegramid', str(tgid).encode('UTF-8'))]
+            modlist = [(ldap.MOD_REPLACE, 'telegramid', tgid_b)]
             if nickname is None:
                 modlist.append((ldap.MOD_DELETE, 'telegramnickname', None))
             else:
                 modlist.append((ldap.MOD_REPLACE, 'telegramnickname', nickname.encode('UTF-8')))
             c.modify_s(dn, modlist)
+        # Not unknown anymore
+        with self.__lock:
+            self.__unknown.pop(tgid, None)
 
     def delete_cache(self) -> int:
-        busted = len(self.__users)
-        self.__users = {}
+        with self.__lock:
+            busted = len(self.__users)
+            self.__users = OrderedDict()
+            self.__unknown = OrderedDict()
         return busted
 
 
 @dataclass
 class Person:
+    # Most people are synced and never looked at, so cn and nickname are kept as they come from LDAP and decoded later
+    __slots__ = ('uid', 'cn_b', 'isadmin', 'nickname_b', 'tgid')
     uid: str
-    cn: str
+    cn_b: bytes
     isadmin: bool
-    nickname: Optional[str]
+    nickname_b: Optional[bytes]
     tgid: Optional[int]
 
+    @property
+    def cn(self) -> str:
+        return self.cn_b.decode()
+
+    @property
+    def nickname(self) -> Optional[str]:
+        return None if self.nickname_b is None else self.nickname_b.decode()
+
 
 class People:
     def __init__(self, admin_groups: List[str], tree: str):
@@ -124,11 +267,16 @@ class People:
         self.last_update = 0
         self.tree = tree
         self.admin_groups = admin_groups
+        if admin_groups:
+            groups = "".join(f"(memberOf={escape_filter_chars(group)})" for group in admin_groups)
+            self.admin_filter = f"(&(objectClass=weeeOpenPerson)(|{groups}))"
+        else:
+            self.admin_filter = None
 
     def get(self, uid: str, conn: LdapConnection) -> Optional[Person]:
         if time() - self.last_update > 3600:
             with conn as c:
-                print("Sync people from LDAP")
+                logger.info("Sync people from LDAP")
                 self.__sync(c)
         uid = uid.lower()
         if uid in self.__people:
@@ -143,92 +291,124 @@ class People:
         return busted
 
     def __sync(self, conn):
-        result = conn.search_s(self.tree, ldap.SCOPE_SUBTREE, f"(objectClass=weeeOpenPerson)", (
-            'uid',
-            'cn',
-            'memberof',
-            'telegramnickname',
-            'telegramid'
-        ))
-
-        for dn, attributes in result:
-            person = Person(
-                attributes['uid'][0].decode(),
-                attributes['cn'][0].decode(),
-                User.is_admin(self.admin_groups, attributes),
-                attributes['telegramnickname'][0].decode() if 'telegramnickname' in attributes else None,
-                int(attributes['telegramid'][0].decode()) if 'telegramid' in attributes else None,
-            )
-            self.__people[person.uid.lower()] = person
+        admins = self.__search_admins(conn)
+
+        set_person = self.__people.__setitem__
+        # Ask for a page at a time, so the server can stream results and we don't hold all of them at once
+        paging = SimplePagedResultsControl(True, size=500, cookie='')
+        while True:
+            msgid = conn.search_ext(self.tree, ldap.SCOPE_SUBTREE, FILTER_PEOPLE, PERSON_ATTRS, serverctrls=[paging])
+            rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+
+            for dn, attributes in rdata:
+                uid = attributes['uid'][0].decode()
+                key = uid.lower()
+                nickname = attributes.get('telegramnickname')
+                tgid = attributes.get('telegramid')
+                set_person(key, Person(
+                    uid,
+                    attributes['cn'][0],
+                    key in admins,
+                    nickname[0] if nickname else None,
+                    int(tgid[0]) if tgid else None,
+                ))
+
+            paging.cookie = None
+            for control in serverctrls:
+                if control.controlType == SimplePagedResultsControl.controlType:
+                    paging.cookie = control.cookie
+            if not paging.cookie:
+                break
 
         self.last_update = time()
 
+    def __search_admins(self, conn) -> Set[str]:
+        """
+        Get admins with a separate search, instead of downloading and checking memberof for everyone
+
+        :param conn: LDAP Connection
+        :return: lowercase uids of admins
+        """
+        if self.admin_filter is None:
+            return set()
+        result = conn.search_s(self.tree, ldap.SCOPE_SUBTREE, self.admin_filter, ('uid',))
+        return set(attributes['uid'][0].decode().lower() for dn, attributes in result)
+
 # noinspection PyAttributeOutsideInit
 @dataclass
 class User:
+    # Names are rarely needed, keep them as bytes and decode on access
+    __slots__ = ('dn', 'tgid', 'uid', 'cn_b', 'givenname_b', 'surname_b', 'isadmin', 'nickname', 'last_update', 'expires_at')
     dn: str
     tgid: int
     uid: str
-    cn: str
-    givenname: str
-    surname: str
+    cn_b: bytes
+    givenname_b: bytes
+    surname_b: bytes
     isadmin: bool
     nickname: Optional[str]
+    ttl: InitVar[int]
+
+    @property
+    def cn(self) -> str:
+        return self.cn_b.decode()
 
-    def __post_init__(self):
-        self.__set_update_time()
+    @property
+    def givenname(self) -> str:
+        return self.givenname_b.decode()
 
-    def __set_update_time(self):
+    @property
+    def surname(self) -> str:
+        return self.surname_b.decode()
+
+    def __post_init__(self, ttl: int):
+        self.__set_update_time(ttl)
+
+    def __set_update_time(self, ttl: int):
         self.last_update = time()
+        self.expires_at = self.last_update + ttl
 
     def need_update(self):
-        return time() - self.last_update > 3600
+        return time() > self.expires_at
 
-    def update(self, conn, admin_groups: List[str], also_nickname: bool, nickname: Optional[str] = None):
+    def update(self, conn, admin_groups: FrozenSet[bytes], also_nickname: bool, nickname: Optional[str] = None,
+               ttl: int = 3600):
         """
         Update user (if cached result is old)
 
         :param conn: LDAP Connection
-        :param admin_groups: Users that belong to these groups are considered admins
+        :param admin_groups: Users that belong to these groups (lowercase encoded DNs) are considered admins
         :param also_nickname: Also update the nickname, if false the nickname parameter is ignored
         :param nickname: New nickname, will be updated if needed
+        :param ttl: Seconds before the user needs another update
         :return: attributes, dn
         """
-        print(f"Update {self.tgid} ({self.dn})")
-        result = conn.read_s(self.dn, None, (
-            'uid',
-            'cn',
-            'givenname',
-            'sn',
-            'memberof',
-            'telegramnickname',
-            'telegramid',
-            'nsaccountlock'
-        ))
-        if len(result) == 0:
+        logger.debug("Update %d (%s)", self.tgid, self.dn)
+        # A base search on a DN returns one entry at most: read_s gives us its attributes directly
+        try:
+            attributes = conn.read_s(self.dn, None, USER_ATTRS)
+        except ldap.NO_SUCH_OBJECT:
+            attributes = None
+        if attributes is None:
             raise AccountNotFoundError()
-        if len(result) > 1:
-            raise DuplicateEntryError(f"DN {self.dn} associated to {len(result)} entries (how!?)")
-
-        dn, attributes = User.__extract_the_only_result(result)
-        del result
 
         if 'nsaccountlock' in attributes:
             raise AccountLockedError()
 
         # self.tgid = int(attributes['tgid'][0].decode())
         self.uid = attributes['uid'][0].decode()
-        self.cn = attributes['cn'][0].decode()
-        self.givenname = attributes['givenname'][0].decode()
-        self.surname = attributes['surname'][0].decode()
+        self.cn_b = attributes['cn'][0]
+        self.givenname_b = attributes['givenname'][0]
+        self.surname_b = attributes['sn'][0]
         self.isadmin = User.is_admin(admin_groups, attributes)
         if also_nickname:
             if User.__get_stored_nickname(attributes) != nickname:
-                User.__update_nickname(dn, nickname, conn)
-        self.__set_update_time()
+                User.__update_nickname(self.dn, nickname, conn)
+        self.__set_update_time(ttl)
 
     @staticmethod
-    def search(tgid: int, tgnick: Optional[str], admin_groups, conn, tree: str, invite_tree: str):
+    def search(tgid: int, tgnick: Optional[str], admin_groups: FrozenSet[bytes], conn, tree: str, invite_tree: str,
+               ttl: int = 3600):
         """
         Get User from Telegram ID. Or nickname as a fallback, Also update nickname and ID if needed.
 
@@ -236,11 +416,12 @@ class User:
         :param invite_tree: Invites tree DN
         :param tgid: Telegram ID
         :param tgnick: Telegram nickname
-        :param admin_groups: Users that belong to these groups are considered admins
+        :param admin_groups: Users that belong to these groups (lowercase encoded DNs) are considered admins
         :param tree: Users tree DN
+        :param ttl: Seconds before the user needs an update
         :return: attributes, dn
         """
-        print(f"Search {tgid}")
+        logger.debug("Search %s", tgid)
         tgid = int(tgid)  # Safety measure
         try:
             attributes, dn = User.__search_by_tgid(conn, invite_tree, tgid, tree)
@@ -248,7 +429,7 @@ class User:
             if tgnick is None:
                 raise e
             else:
-                attributes, dn = User.__search_by_nickname(conn, invite_tree, tgnick, tgid, tree)
+                attributes, dn = User.__search_by_nickname(conn, tgnick, tgid, tree)
 
         if 'nsaccountlock' in attributes:
             raise AccountLockedError()
@@ -259,7 +440,7 @@ class User:
         if nickname != tgnick:
             User.__update_nickname(dn, tgnick, conn)
         # self.__set_update_time() done in __post_init___
-        return User(dn, tgid, attributes['uid'][0].decode(), attributes['cn'][0].decode(), attributes['givenname'][0].decode(), attributes['sn'][0].decode(), isadmin, tgnick)
+        return User(dn, tgid, attributes['uid'][0].decode(), attributes['cn'][0], attributes['givenname'][0], attributes['sn'][0], isadmin, tgnick, ttl)
 
     @staticmethod
     def __search_by_tgid(conn, invite_tree, tgid, tree) -> Tuple[Dict, str]:
@@ -272,18 +453,11 @@ class User:
         :param tree: Users tree DN
         :return: attributes, dn
         """
-        result = conn.search_s(tree, ldap.SCOPE_SUBTREE, f"(&(objectClass=weeeOpenPerson)(telegramId={tgid}))", (
-            'uid',
-            'cn',
-            'givenname',
-            'sn',
-            'memberof',
-            'telegramnickname',
-            'telegramid',
-            'nsaccountlock'
-        ))
+        msgid = conn.search_ext(tree, ldap.SCOPE_SUBTREE, FILTER_USER_BY_TGID % tgid, USER_ATTRS)
+        _, result = conn.result(msgid, all=1)
         if len(result) == 0:
             # TODO: this part can be removed, once every old user has signed up to the SSO
+            # Only searched when the user doesn't exist, which is rare (and unknown IDs are cached for a while)
             invite = User.__get_invite_from_tgid(tgid, invite_tree, conn)
             if invite is None:
                 raise AccountNotFoundError()
@@ -292,25 +466,23 @@ class User:
         if len(result) > 1:
             raise DuplicateEntryError(f"Telegram ID {tgid} associated to {len(result)} entries")
         dn, attributes = User.__extract_the_only_result(result)
-        del result
         return attributes, dn
 
     @staticmethod
-    def __search_by_nickname(conn, invite_tree, tgnick: str, tgid: int, tree) -> Tuple[Dict, str]:
+    def __search_by_nickname(conn, tgnick: str, tgid: int, tree) -> Tuple[Dict, str]:
         """
         Search a user by nickname IF Telegram ID is not set.
-        If found, update their Telegram ID, search again by ID and return the usual attributes.
+        If found, update their Telegram ID, read the entry again and return the usual attributes.
 
         :param conn: LDAP Connection
-        :param invite_tree: Invites tree DN
         :param tgnick: Telegram nickname
         :param tgid: Telegram ID
         :param tree: Users tree DN
         :return: attributes, dn
         """
-        print(f"Search {tgnick}")
+        logger.debug("Search %s", tgnick)
         tgnick = ldap.filter.escape_filter_chars(tgnick)
-        result = conn.search_s(tree, ldap.SCOPE_SUBTREE, f"(&(objectClass=weeeOpenPerson)(!(telegramId=*))(telegramNickname={tgnick}))", ())
+        result = conn.search_s(tree, ldap.SCOPE_SUBTREE, FILTER_USER_BY_NICKNAME % tgnick, ())
         if len(result) == 0:
             raise AccountNotFoundError()
         if len(result) > 1:
@@ -319,17 +491,21 @@ class User:
         dn = result[0][0]
         User.__update_id(dn, tgid, conn)
 
-        return User.__search_by_tgid(conn, invite_tree, tgid, tree)
+        # We already have the DN, no need for another subtree search by ID
+        attributes = conn.read_s(dn, None, USER_ATTRS)
+        if attributes is None:
+            raise AccountNotFoundError()
+        return attributes, dn
 
     @staticmethod
     def __get_invite_from_tgid(tgid: int, invite_tree: str, conn):
-        result = conn.search_s(invite_tree, ldap.SCOPE_SUBTREE, f"(&(inviteCode=*)(telegramId={tgid}))", ('*',))
+        msgid = conn.search_ext(invite_tree, ldap.SCOPE_SUBTREE, FILTER_INVITE_BY_TGID % tgid, ('*',))
+        _, result = conn.result(msgid, all=1)
         if len(result) == 0:
             return None
         if len(result) > 1:
             raise DuplicateEntryError(f"Telegram ID {tgid} associated to {len(result)} invites")
         dn, attributes = User.__extract_the_only_result(result)
-        del result
         return attributes['inviteCode'][0].decode()
 
     @staticmethod
@@ -341,13 +517,9 @@ class User:
         return nickname
 
     @staticmethod
-    def is_admin(admin_groups, attributes):
-        if 'memberof' not in attributes:
-            return False
-        for group in attributes['memberof']:
-            if group.decode() in admin_groups:
-                return True
-        return False
+    def is_admin(admin_groups: FrozenSet[bytes], attributes):
+        # admin_groups are lowercased as bytes too (ASCII only), DNs are case-insensitive
+        return any(group.lower() in admin_groups for group in attributes.get('memberof', ()))
 
     @staticmethod
     def __extract_the_only_result(result):
@@ -370,5 +542,5 @@ class User:
     @staticmethod
     def __update_id(dn: str, new_id: int, conn):
         conn.modify_s(dn, [
-            (ldap.MOD_REPLACE, 'telegramId', str(new_id).encode('UTF-8'))
+            (ldap.MOD_REPLACE, 'telegramId', str(new_id).encode('ascii'))
         ])
@@ -1,16 +1,25 @@
 import datetime
-import re
+import json
+import logging
+import os
+import tempfile
 from time import time
 # noinspection PyUnresolvedReferences
 import owncloud
 import pytz
 
+logger = logging.getLogger(__name__)
+
 
 class WeeelabLogs:
-    def __init__(self, oc: owncloud, log_path: str, log_base: str, user_bot_path: str):
+    def __init__(self, oc: owncloud, log_path: str, log_base: str, user_bot_path: str, old_logs_cache: str = None):
         self.log = []
+        # (day, index of its first line in self.log) for each run of consecutive lines on the same day
+        self.day_offsets = []
         self.log_last_download = None
         self.log_last_update = None
+        # Last modified date of the log file, as reported by the server, when it was downloaded
+        self.log_last_modified = None
         self.error = None
         self.oc = oc
 
@@ -18,46 +27,93 @@ class WeeelabLogs:
         self.log_base = log_base
         self.user_bot_path = user_bot_path
 
-        # Logs from past months (no lines from current month)
-        self.old_log = []
+        # Local file where totals from past months are saved, since they never change
+        self.old_logs_cache = old_logs_cache
+        # Minutes spent in lab per username, updated whenever lines are added to self.log or past months are parsed
+        self.minutes_month = {}
+        # Same, for each past month: (year, month) as key. Lines from past months are not kept, only these totals.
+        self.minutes_old_months = {}
+        # Sum of all the past months
+        self.minutes_old = {}
+        self.old_log_lines = 0
         # Logs start from april 2017, these variables represent which log file has been fetched last, so it will start
         # from the first one that actually exists (april 2017)
         self.old_logs_month = 3
         self.old_logs_year = 2017
         self.local_tz = pytz.timezone("Europe/Rome")
+        self.__load_old_logs_cache()
+
+    def ensure_fresh(self, old_logs: bool = False):
+        """
+        Make sure logs are up to date. Commands arriving within 30 seconds share the same check.
+
+        :param old_logs: Also download logs from past months, if needed
+        :return: self
+        """
+        if old_logs:
+            self.get_old_logs()
+        return self.get_log()
 
     def get_log(self):
         if self.log_last_download is not None and time() - self.log_last_download < 30:
             return self
 
-        self.log = []
-        log_file = self.oc.get_file_contents(self.log_path).decode('utf-8')
-        log_lines = log_file.splitlines()
-
-        for line in log_lines:
-            self.log.append(WeeelabLine(line))
-
-        # store the date of the last update of the log file,
-        # the data is in UTC so we convert it to local timezone
+        # Asking for file info is cheap, downloading and parsing the whole file is not: do that only if it changed
         last_update_utc = self.oc.file_info(self.log_path).get_last_modified()
-        self.log_last_update = pytz.utc.localize(last_update_utc, is_dst=None).astimezone(self.local_tz)
+        if self.log_last_modified is None or self.log_last_modified != last_update_utc:
+            self.log = [WeeelabLine(line) for line in self.__download_lines(self.log_path)]
+            self.day_offsets = []
+            for index, line in enumerate(self.log):
+                day = line.day()
+                if len(self.day_offsets) == 0 or self.day_offsets[-1][0] != day:
+                    self.day_offsets.append((day, index))
+            self.minutes_month = {}
+            self.__add_minutes(self.minutes_month, self.log)
+
+            # store the date of the last update of the log file,
+            # the data is in UTC so we convert it to local timezone
+            self.log_last_modified = last_update_utc
+            self.log_last_update = pytz.utc.localize(last_update_utc, is_dst=None).astimezone(self.local_tz)
         self.log_last_download = time()
 
         return self
 
     def delete_cache(self) -> int:
-        lines = len(self.log) + len(self.old_log)
+        lines = len(self.log) + self.old_log_lines
 
         self.log = []
+        self.day_offsets = []
         self.log_last_download = None
         self.log_last_update = None
+        self.log_last_modified = None
         self.error = None
-        self.old_log = []
+        self.minutes_month = {}
+        self.minutes_old_months = {}
+        self.minutes_old = {}
+        self.old_log_lines = 0
         self.old_logs_month = 3
         self.old_logs_year = 2017
+        self.__delete_old_logs_cache()
 
         return lines
 
+    def first_line_of_last_days(self, days: int) -> int:
+        """
+        Find where the lines of the last days begin, in the current log
+
+        :param days: How many different days
+        :return: Index in self.log
+        """
+        seen = set()
+        start = len(self.log)
+        for day, index in reversed(self.day_offsets):
+            if day not in seen:
+                if len(seen) >= days:
+                    break
+                seen.add(day)
+            start = index
+        return start
+
     def get_old_logs(self):
         today = datetime.date.today()
         prev_month = today.month - 1
@@ -79,6 +135,7 @@ class WeeelabLogs:
         """
         year = self.old_logs_year
         month = self.old_logs_month
+        downloaded = False
 
         while True:
             month += 1
@@ -89,47 +146,161 @@ class WeeelabLogs:
                 break
 
             filename = self.log_base + "log" + str(year) + str(month).zfill(2) + ".txt"
-            print(f"Downloading {filename}")
+            logger.info("Downloading %s", filename)
             try:
-                log_file = self.oc.get_file_contents(filename).decode('utf-8')
-                log_lines = log_file.splitlines()
-
-                for line in log_lines:
-                    self.old_log.append(WeeelabLine(line))
+                month_minutes = {}
+                month_lines = 0
+                for line in self.__download_lines(filename):
+                    line = WeeelabLine(line)
+                    month_minutes[line.username] = month_minutes.get(line.username, 0) + line.minutes
+                    month_lines += 1
             except owncloud.owncloud.HTTPResponseError:
-                print(f"Failed downloading {filename}, will try again next time")
+                logger.warning("Failed downloading %s, will try again next time", filename)
                 # Roll back to the previous month, since that's the last we have
                 month -= 1
                 if month == 0:
                     month = 12
                     year -= 1
                 break
+            self.minutes_old_months[(year, month)] = month_minutes
+            self.__merge_minutes(self.minutes_old, month_minutes)
+            self.old_log_lines += month_lines
+            downloaded = True
 
         self.old_logs_month = month
         self.old_logs_year = year
+        if downloaded:
+            self.__save_old_logs_cache()
 
-    def count_time_user(self, username):
+    def __load_old_logs_cache(self):
         """
-        Count time spent in lab for this user
+        Read totals from past months saved by a previous run, so they don't have to be downloaded again
+        """
+        if self.old_logs_cache is None:
+            return
+        try:
+            with open(self.old_logs_cache, encoding='utf-8') as file:
+                cache = json.load(file)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning("Cannot read %s, old logs will be downloaded again: %s", self.old_logs_cache, e)
+            return
+        except ValueError as e:
+            logger.warning("%s is not valid JSON, old logs will be downloaded again: %s", self.old_logs_cache, e)
+            self.__delete_old_logs_cache()
+            return
 
-        :param username:
-        :return: Minutes this month and in total
+        # Parse everything before touching any attribute, a broken file must not leave half of it loaded
+        try:
+            minutes_old_months = {}
+            minutes_old = {}
+            for key, month_minutes in cache['months'].items():
+                year, month = key.split('-')
+                year, month = int(year), int(month)
+                if not 1 <= month <= 12:
+                    raise ValueError(f"month {key} out of range")
+                for username, minutes in month_minutes.items():
+                    if not isinstance(username, str) or not isinstance(minutes, int):
+                        raise ValueError(f"bad entry {username!r}: {minutes!r} in {key}")
+                minutes_old_months[(year, month)] = month_minutes
+                self.__merge_minutes(minutes_old, month_minutes)
+            lines = cache['lines']
+            if not isinstance(lines, int):
+                raise ValueError(f"bad line count {lines!r}")
+            last_year, last_month = cache['last']
+            if not isinstance(last_year, int) or not isinstance(last_month, int) or not 1 <= last_month <= 12:
+                raise ValueError(f"bad last month {cache['last']!r}")
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning("%s is malformed, old logs will be downloaded again: %s", self.old_logs_cache, e)
+            self.__delete_old_logs_cache()
+            return
+
+        self.minutes_old_months = minutes_old_months
+        self.minutes_old = minutes_old
+        self.old_log_lines = lines
+        self.old_logs_year = last_year
+        self.old_logs_month = last_month
+
+    def __delete_old_logs_cache(self):
+        if self.old_logs_cache is None:
+            return
+        try:
+            os.remove(self.old_logs_cache)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Cannot delete %s: %s", self.old_logs_cache, e)
+
+    def __save_old_logs_cache(self):
+        """
+        Save totals from past months to disk, they will never change anyway
         """
-        minutes_thismonth = 0
+        if self.old_logs_cache is None:
+            return
+        cache = {
+            'last': [self.old_logs_year, self.old_logs_month],
+            'lines': self.old_log_lines,
+            'months': {f"{year}-{month:02d}": minutes for (year, month), minutes in self.minutes_old_months.items()},
+        }
+        try:
+            directory = os.path.dirname(self.old_logs_cache)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Write to another file and rename it, so a crash cannot leave half a file around
+            with open(self.old_logs_cache + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(cache, file)
+            os.replace(self.old_logs_cache + '.tmp', self.old_logs_cache)
+        except OSError as e:
+            logger.warning("Cannot write %s: %s", self.old_logs_cache, e)
+
+    def __download_lines(self, path: str):
+        """
+        Download a file and read it one line at a time, without holding all of it in memory
 
-        # noinspection PyUnusedLocal
-        line: WeeelabLine
-        for line in self.log:
-            if line.username == username:
-                minutes_thismonth += line.duration_minutes()
+        :param path: Path on the OwnCloud server
+        :return: Generator of lines, without line terminators
+        """
+        with tempfile.NamedTemporaryFile() as local_file:
+            # This streams the file to disk in chunks, get_file_contents would return it all as a single bytes object
+            self.oc.get_file(path, local_file.name)
+            with open(local_file.name, encoding='utf-8') as file:
+                for line in file:
+                    yield line.rstrip('\r\n')
 
-        minutes_total = minutes_thismonth
+    @staticmethod
+    def __add_minutes(minutes: dict, lines):
+        """
+        Add time spent in lab in these lines to a dict
 
+        :param minutes: Dict with username as key, minutes as value
+        :param lines: WeeelabLine list
+        """
         # noinspection PyUnusedLocal
         line: WeeelabLine
-        for line in self.old_log:
-            if line.username == username:
-                minutes_total += line.duration_minutes()
+        for line in lines:
+            minutes[line.username] = minutes.get(line.username, 0) + line.minutes
+
+    @staticmethod
+    def __merge_minutes(minutes: dict, other: dict):
+        """
+        Add minutes from another dict to a dict
+
+        :param minutes: Dict with username as key, minutes as value
+        :param other: Same, won't be modified
+        """
+        for username, other_minutes in other.items():
+            minutes[username] = minutes.get(username, 0) + other_minutes
+
+    def count_time_user(self, username):
+        """
+        Count time spent in lab for this user
+
+        :param username:
+        :return: Minutes this month and in total
+        """
+        minutes_thismonth = self.minutes_month.get(username, 0)
+        minutes_total = minutes_thismonth + self.minutes_old.get(username, 0)
 
         return minutes_thismonth, minutes_total
 
@@ -139,16 +310,7 @@ class WeeelabLogs:
 
         :return: Dict with username as key, minutes as value
         """
-        minutes = {}
-
-        # noinspection PyUnusedLocal
-        line: WeeelabLine
-        for line in self.log:
-            if line.username not in minutes:
-                minutes[line.username] = 0
-            minutes[line.username] += line.duration_minutes()
-
-        return minutes
+        return self.minutes_month.copy()
 
     def count_time_all(self):
         """
@@ -158,13 +320,7 @@ class WeeelabLogs:
         """
         # Start from that
         minutes = self.count_time_month()
-
-        # noinspection PyUnusedLocal
-        line: WeeelabLine
-        for line in self.old_log:
-            if line.username not in minutes:
-                minutes[line.username] = 0
-            minutes[line.username] += line.duration_minutes()
+        self.__merge_minutes(minutes, self.minutes_old)
 
         return minutes
 
@@ -182,9 +338,9 @@ class WeeelabLogs:
 
     def store_new_user(self, tid, name: str, surname: str, username: str):
         new_users_file = self.oc.get_file_contents(self.user_bot_path)
-        new_users = new_users_file.decode('utf-8')
 
-        if str(tid) in new_users:
+        # Lines end with ": tid", no need to decode the whole file to look for it
+        if f": {tid}\n".encode('utf-8') in new_users_file:
             return
         else:
             # Store a new user name and id in a file on owncloud server,
@@ -196,11 +352,10 @@ class WeeelabLogs:
                     username = " (no username)"
                 else:
                     username = f" (@{username})"
-                new_users = new_users + "{}{}{}: {}\n".format(name, surname, username, tid)
-                self.oc.put_file_contents(self.user_bot_path, new_users.encode('utf-8'))
+                new_user = "{}{}{}: {}\n".format(name, surname, username, tid)
+                self.oc.put_file_contents(self.user_bot_path, new_users_file + new_user.encode('utf-8'))
             except (AttributeError, UnicodeEncodeError):
-                print("ERROR writing user.txt")
-                pass
+                logger.warning("Error writing user.txt", exc_info=True)
 
     @staticmethod
     def get_name_and_surname(user_entry: dict):
@@ -231,29 +386,37 @@ class WeeelabLogs:
 
 
 class WeeelabLine:
-    regex = re.compile('\[([^\]]+)\]\s*\[([^\]]+)\]\s*\[([^\]]+)\]\s*<([^>]+)>\s*[:{2}]*\s*(.*)')
-
     def __init__(self, line: str):
-        res = self.regex.match(line)
-        self.time_in = res.group(1)
-        self.time_out = res.group(2)
-        self.duration = res.group(3)
-        self.username = res.group(4)
-        self.text = res.group(5)
+        # Lines are "[time in] [time out] [duration] <username> :: text", find the delimiters instead of using a regex
+        a = line.index('[')
+        b = line.index(']', a)
+        c = line.index('[', b)
+        d = line.index(']', c)
+        e = line.index('[', d)
+        f = line.index(']', e)
+        g = line.index('<', f)
+        h = line.index('>', g)
+        self.time_in = line[a + 1:b]
+        self.time_out = line[c + 1:d]
+        self.duration = line[e + 1:f]
+        self.username = line[g + 1:h]
+        text = line[h + 1:].lstrip()
+        if text.startswith('::'):
+            text = text[2:].lstrip()
+        self.text = text
 
         if self.duration == "INLAB":
             self.time_out = None
             self.inlab = True
+            # TODO: calculate partials (time right now - time in)
+            self.minutes = 0
         else:
             self.inlab = False
+            hh, mm = self.duration.split(':', 1)
+            self.minutes = int(hh) * 60 + int(mm)
 
     def day(self):
         return self.time_in.split(" ")[0]
 
     def duration_minutes(self):
-        # TODO: calculate partials (time right now - time in)
-        if self.inlab:
-            return 0
-
-        parts = self.duration.split(':')
-        return int(parts[0]) * 60 + int(parts[1])
+        return self.minutes
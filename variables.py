@@ -2,12 +2,7 @@ import os  # system library needed to read the environment variables
 
 
 def __unpack_wol(wol):
-    wol = wol.split('|')
-    result = {}
-    for machine in wol:
-        machine = machine.split(':', 1)
-        result[machine[0]] = machine[1]
-    return result
+    return {name: mac for name, mac in (machine.split(':', 1) for machine in wol.split('|'))}
 
 
 # get environment variables
@@ -21,6 +16,7 @@ TOLAB_PATH = os.environ.get('TOLAB_PATH')
 LOG_BASE = os.environ.get('LOG_BASE')
 # path of the file to store bot users in OwnCloud (/folder/file.txt)
 USER_BOT_PATH = os.environ.get('USER_BOT_PATH')
+OLD_LOGS_CACHE = os.environ.get('OLD_LOGS_CACHE', 'data/old_logs.json')  # local file with totals from past months
 TOKEN_BOT = os.environ.get('TOKEN_BOT')  # Telegram token for the bot API
 TARALLO = os.environ.get('TARALLO')  # tarallo URL
 TARALLO_TOKEN = os.environ.get('TARALLO_TOKEN')  # tarallo token
@@ -33,7 +29,12 @@ LDAP_TREE_PEOPLE = os.environ.get('LDAP_TREE_PEOPLE')  # ou=People,dc=weeeopen,d
 LDAP_TREE_INVITES = os.environ.get('LDAP_TREE_INVITES')  # ou=Invites,dc=weeeopen,dc=it
 LDAP_ADMIN_GROUPS = os.environ.get('LDAP_ADMIN_GROUPS')  # ou=Group,dc=weeeopen,dc=it|ou=OtherGroup,dc=weeeopen,dc=it
 if LDAP_ADMIN_GROUPS is not None:
-    LDAP_ADMIN_GROUPS = LDAP_ADMIN_GROUPS.split('|')
+    # DNs are case-insensitive, Users lowercases these and memberof values the same way before comparing them
+    LDAP_ADMIN_GROUPS = [group.strip() for group in LDAP_ADMIN_GROUPS.split('|')]
+LDAP_POOL_SIZE = int(os.environ.get('LDAP_POOL_SIZE', 2))  # bound connections kept open, 2 is enough for the bot
+MAX_CACHED_USERS = int(os.environ.get('MAX_CACHED_USERS', 1000))  # users kept in cache, least recently used are dropped
+USERS_CACHE_TTL = int(os.environ.get('USERS_CACHE_TTL', 3600))  # seconds before a cached user is read again from LDAP
+UNKNOWN_USERS_TTL = int(os.environ.get('UNKNOWN_USERS_TTL', 300))  # seconds before an unknown Telegram ID is searched again
 
 INVITE_LINK = os.environ.get('INVITE_LINK')  # https://example.com/register.php?invite= (invite code will be appended, no spaces in invite code)
 
@@ -46,5 +47,7 @@ if WOL_MACHINES is not None:
     WOL_MACHINES = __unpack_wol(WOL_MACHINES)
 WOL_LOGOUT = os.environ.get('WOL_LOGOUT')  # 00:0a:0b:0c:0d:0e
 
-MAX_WORK_DONE = int(os.environ.get('MAX_WORK_DONE'))  # 2000
+MAX_WORK_DONE = int(os.environ.get('MAX_WORK_DONE') or 2000)  # 2000
+
+LOGGING_LEVEL = os.environ.get('LOGGING_LEVEL', 'INFO')  # DEBUG, INFO, WARNING, ...
 
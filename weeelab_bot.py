@@ -19,7 +19,9 @@ Author: WEEE Open Team
 
 # Modules
 import json
-from typing import Optional, List
+import logging
+import re
+from typing import Optional
 
 from pytarallo.AuditEntry import AuditEntry, AuditChanges
 from pytarallo.Errors import ItemNotFoundError, AuthenticationError
@@ -32,17 +34,27 @@ from ToLab import ToLab
 from Weeelablib import WeeelabLogs
 from variables import *  # internal library with the environment variables
 import requests  # send HTTP requests to Telegram server
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 # noinspection PyUnresolvedReferences
 import owncloud
 import datetime
-import traceback  # Print stack traces in logs
 import simpleaudio
 from stream_yt_audio import LofiVlcPlayer
 from enum import Enum
+from itertools import cycle
+from operator import itemgetter
 from time import sleep
 from remote_commands import ssh_command
 from ssh_util import SSHUtil
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("weeelab_bot")
+
+
+# Only the updates handled in handle_update, Telegram won't send anything else (e.g. edited messages)
+ALLOWED_UPDATES = json.dumps(["message", "callback_query", "channel_post"])
 
 
 class BotHandler:
@@ -50,18 +62,28 @@ class BotHandler:
     class with method used by the bot, for more details see https://core.telegram.org/bots/api
     """
 
+    # (connect, read) timeouts in seconds for everything but long polling, requests waits forever by default
+    TIMEOUT = (5, 35)
+
     def __init__(self, token):
         """
         init function to set bot token and reference url
         """
-        print("Bot handler started")
+        logger.info("Bot handler started")
         self.token = token
         self.api_url = "https://api.telegram.org/bot{}/".format(token)
         self.offset = None
+        # Keep connections to Telegram alive instead of doing a TLS handshake for every request
+        self.session = requests.Session()
+        # No retries on read timeouts: a stalled long poll would block for 4 times as long, and read=False (unlike
+        # read=0) makes requests raise Timeout instead of a ConnectionError wrapping MaxRetryError
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                                   max_retries=Retry(total=3, read=False, backoff_factor=0.2)))
+        # Messages are sent from this thread, in order, so handlers don't wait for each one to reach Telegram
+        self.outbox = ThreadPoolExecutor(max_workers=1)
 
         # These are returned when a user sends an unknown command.
-        self.unknown_command_messages_last = -1
-        self.unknown_command_messages = [
+        self.unknown_command_messages = cycle([
             "Sorry, I didn't understand that.\nWanna try /history? That one I do understand",
             "Sorry, I didn't understand that.\nWanna try /tolab? That one I do understand",
             "I don't know that command, but do you know /history? It's pretty cool",
@@ -72,32 +94,35 @@ class BotHandler:
             "Unknown command. But do you know /tolab? It's pretty cool",
             "Bad command or file name.\nDo you know what's good? /history",
             "Bad command or file name.\nDo you know what's good? /tolab",
-        ]
+        ])
 
-    def get_updates(self, timeout=120):
+    def get_updates(self, timeout=50):
         """
         method to receive incoming updates using long polling
         [Telegram API -> getUpdates ]
         """
-        params = {'offset': self.offset, 'timeout': timeout}
+        # Telegram doesn't wait more than 50 seconds anyway
+        params = {'offset': self.offset, 'timeout': timeout, 'allowed_updates': ALLOWED_UPDATES}
         requests_timeout = timeout + 5
-        # noinspection PyBroadException
         try:
-            result = requests.get(self.api_url + 'getUpdates', params, timeout=requests_timeout).json()['result']
+            result = self.session.get(self.api_url + 'getUpdates', params=params, timeout=(5, requests_timeout)).json()['result']
             if len(result) > 0:
                 self.offset = result[-1]['update_id'] + 1
             return result
-        except requests.exceptions.Timeout:
-            print(f"Polling timed out after f{str(requests_timeout)} seconds")
-            return None
-        except Exception as e:
-            print("Failed to get updates: " + str(e))
-            return None
+        except requests.Timeout:
+            logger.warning("Polling timed out after %d seconds", requests_timeout)
+            return []
+        except (requests.RequestException, ValueError, KeyError) as e:
+            # ValueError if the response is not JSON, KeyError if it has no result
+            logger.warning("Failed to get updates: %s", e)
+            # Don't hammer the server if it's down
+            sleep(1)
+            return []
 
     def send_message(self, chat_id, text, parse_mode='HTML', disable_web_page_preview=True, reply_markup=None):
         """
         method to send text messages [ Telegram API -> sendMessage ]
-        On success, the sent Message is returned.
+        The message is queued and sent in background, in the same order as calls to this method.
         """
         params = {
             'chat_id': chat_id,
@@ -107,7 +132,7 @@ class BotHandler:
         }
         if reply_markup is not None:
             params['reply_markup'] = {"inline_keyboard": reply_markup}
-        self.__do_post('sendMessage', params)
+        self.outbox.submit(self.__do_post, 'sendMessage', params)
 
     def edit_message(self, chat_id: int, message_id: int, text: Optional[str] = None, reply_markup=None,
                      parse_mode='HTML', disable_web_page_preview=True):
@@ -121,48 +146,50 @@ class BotHandler:
             params["disable_web_page_preview"] = disable_web_page_preview
         if reply_markup is not None:
             params["reply_markup"] = {"inline_keyboard": reply_markup}
-        self.__do_post("editMessageText", params)
+        self.outbox.submit(self.__do_post, "editMessageText", params)
 
     def __do_post(self, endpoint, params):
-        result = requests.post(self.api_url + endpoint, json=params)
+        try:
+            result = self.session.post(self.api_url + endpoint, json=params, timeout=self.TIMEOUT)
+        except requests.RequestException as e:
+            # Nobody is waiting for the result, log it or it will be lost
+            logger.error("Failed to send %s: %s\nOur message:\n%s", endpoint, e, json.dumps(params))
+            return
         if result.status_code >= 400:
-            print(f"Telegram server says there's an error: {result.status_code}")
-            print(result.content)
-            print("Our message:")
-            print(json.dumps(params))
-
-    def get_last_update(self):
-        """
-        method to get last message if there is.
-        in case of error return an error code used in the main function
-        """
-        get_result = self.get_updates(120)  # recall the function to get updates
-        if not get_result:
-            return -1
-        elif len(get_result) > 0:  # check if there are new messages
-            return get_result[-1]  # return the last message in json format
-        else:
-            return -1
+            logger.error("Telegram server says there's an error: %d\n%s\nOur message:\n%s",
+                         result.status_code, result.content, json.dumps(params))
 
     def leave_chat(self, chat_id):
         """
-        method to send text messages [ Telegram API -> leaveChat ]
-        On success, the leave Chat returns True.
+        method to leave a chat [ Telegram API -> leaveChat ]
+        Sent in background like messages, errors are logged.
         """
         params = {
             'chat_id': chat_id,
         }
-        return requests.post(self.api_url + 'leaveChat', params)
+        self.outbox.submit(self.__do_post, 'leaveChat', params)
 
     @property
     def unknown_command_message(self):
-        self.unknown_command_messages_last += 1
-        self.unknown_command_messages_last %= len(self.unknown_command_messages)
-        return self.unknown_command_messages[self.unknown_command_messages_last]
+        return next(self.unknown_command_messages)
+
+
+HTML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+# 9, 09, 9:30, 09.30 and so on. [0-9] since \d would also match other digits, e.g. in arabic script
+TOLAB_TIME = re.compile(r'([0-9]{1,2})(?:[:.]([0-9]{2}))?')
+# Line for each type of change in /history, {other} is the location or the old code
+HISTORY_CHANGES = {
+    AuditChanges.Move: '➡️ Moved to <b>{other}</b>\n',
+    AuditChanges.Update: '🛠️ Updated features\n',
+    AuditChanges.Create: '📋 Created\n',
+    AuditChanges.Rename: '✏️ Renamed from <b>{other}</b>\n',
+    AuditChanges.Delete: '❌ Deleted\n',
+    AuditChanges.Lose: '🔍 Lost\n',
+}
 
 
 def escape_all(string):
-    return string.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return string.translate(HTML_ESCAPES)
 
 
 class AcceptableQueriesLoFi(Enum):
@@ -177,6 +204,18 @@ def inline_keyboard_button(label: str, callback_data: str):
     return {"text": label, "callback_data": callback_data}
 
 
+# Only the first button changes, so there are just two possible /lofi keyboards. Don't modify them.
+_LOFI_OTHER_ROWS = [
+    [inline_keyboard_button("🔉 Vol-", callback_data=AcceptableQueriesLoFi.volume_down.value),
+     inline_keyboard_button("🔊 Vol+", callback_data=AcceptableQueriesLoFi.volume_plus.value)],
+    [inline_keyboard_button("❌ Close", callback_data=AcceptableQueriesLoFi.close.value)]
+]
+LOFI_KEYBOARD_PLAYING = [[inline_keyboard_button("⏸ Pause", callback_data=AcceptableQueriesLoFi.pause.value)]] \
+    + _LOFI_OTHER_ROWS
+LOFI_KEYBOARD_STOPPED = [[inline_keyboard_button("▶️ Play", callback_data=AcceptableQueriesLoFi.play.value)]] \
+    + _LOFI_OTHER_ROWS
+
+
 class CommandHandler:
     """
     Aggregates all the possible commands within one class.
@@ -190,7 +229,8 @@ class CommandHandler:
                  users: Users,
                  people: People,
                  conn: LdapConnection,
-                 wol: dict):
+                 wol: dict,
+                 wave_path: str):
         self.bot = bot
         self.tarallo = tarallo
         self.logs = logs
@@ -199,6 +239,9 @@ class CommandHandler:
         self.people = people
         self.conn = conn
         self.wol_dict = wol
+        self.wave_path = wave_path
+        # Loaded on the first /ring, the bell may never be rung before a restart
+        self.wave_obj: Optional[simpleaudio.WaveObject] = None
 
         self.user: Optional[User] = None
         self.__last_from = None
@@ -210,23 +253,21 @@ class CommandHandler:
         self.lofi_player_last_volume = -1
         self.ssh_retry_times = 2
 
-    def read_user_from_callback(self, last_update):
-        self.__last_from = last_update['callback_query']['from']
-        self.__last_chat_id = last_update['callback_query']['message']['chat']['id']
-        self.__last_user_id = last_update['callback_query']['from']['id']
-        self.__last_user_nickname = last_update['callback_query']['from']['username'] \
-            if 'username' in last_update['callback_query']['from'] else None
+    def read_user_from_callback(self, callback_query):
+        self.__last_from = callback_query['from']
+        self.__last_chat_id = callback_query['message']['chat']['id']
+        self.__last_user_id = self.__last_from['id']
+        self.__last_user_nickname = self.__last_from.get('username')
 
         return self.__read_user(None)
 
-    def read_user_from_message(self, last_update):
-        self.__last_from = last_update['message']['from']
-        self.__last_chat_id = last_update['message']['chat']['id']
-        self.__last_user_id = last_update['message']['from']['id']
-        self.__last_user_nickname = last_update['message']['from']['username'] \
-            if 'username' in last_update['message']['from'] else None
+    def read_user_from_message(self, message):
+        self.__last_from = message['from']
+        self.__last_chat_id = message['chat']['id']
+        self.__last_user_id = self.__last_from['id']
+        self.__last_user_nickname = self.__last_from.get('username')
 
-        return self.__read_user(last_update['message']['text'])
+        return self.__read_user(message.get('text'))
 
     def __read_user(self, text: Optional[str]):
         self.user = None
@@ -314,8 +355,15 @@ as well.\nFor a list of the available commands type /help.', )
         Called with /inlab
         """
 
-        inlab = self.logs.get_log().get_entries_inlab()
+        inlab = self.logs.ensure_fresh().get_entries_inlab()
         people_inlab = set()
+        # People who are in lab may also be going later, render each one only once
+        rendered = {}
+
+        def user_in_list(name: str):
+            if name not in rendered:
+                rendered[name] = self.format_user_in_list(name)
+            return rendered[name]
 
         if len(inlab) == 0:
             msg = 'Nobody is in lab right now.'
@@ -325,7 +373,7 @@ as well.\nFor a list of the available commands type /help.', )
             msg = f'There are {str(len(inlab))} students in lab right now:'
 
         for username in inlab:
-            msg += self.format_user_in_list(username)
+            msg += user_in_list(username)
             people_inlab.add(username)
 
         user_themself_inlab = self.user.uid in people_inlab
@@ -334,6 +382,7 @@ as well.\nFor a list of the available commands type /help.', )
 
         if number_of_people_going > 0:
             today = right_now.date()
+            tomorrow = today + datetime.timedelta(days=1)
             if number_of_people_going == 1:
                 msg += '\n\nThere is one student that is going to lab:'
             else:
@@ -343,14 +392,13 @@ as well.\nFor a list of the available commands type /help.', )
             for user in self.tolab_db.tolab_file:
                 username = user["username"]
                 going_day = user["tolab"].date()
-                hh = str(user["tolab"].hour).zfill(2)
-                mm = str(user["tolab"].minute).zfill(2)
+                going_time = f'{user["tolab"]:%H:%M}'
                 if today == going_day:
-                    msg += self.format_user_in_list(username, f" today at {hh}:{mm}")
-                elif today + datetime.timedelta(days=1) == going_day:
-                    msg += self.format_user_in_list(username, f" tomorrow at {hh}:{mm}")
+                    msg += user_in_list(username) + f" today at {going_time}"
+                elif tomorrow == going_day:
+                    msg += user_in_list(username) + f" tomorrow at {going_time}"
                 else:
-                    msg += self.format_user_in_list(username, f" on {str(going_day)} at {hh}:{mm}")
+                    msg += user_in_list(username) + f" on {str(going_day)} at {going_time}"
                 if username == self.user.uid:
                     user_themself_tolab = True
             if not user_themself_tolab and not user_themself_inlab:
@@ -402,7 +450,7 @@ as well.\nFor a list of the available commands type /help.', )
                                         f"\nMark it down on your calendar!")
         except Exception as e:
             self.__send_message(f"An error occurred: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception("Error in /tolab")
 
     @staticmethod
     def _tolab_parse_time(time: str):
@@ -414,21 +462,12 @@ as well.\nFor a list of the available commands type /help.', )
         """
         if time == "no":
             return None
-        elif len(time) == 1 and time.isdigit():
-            return f"0{time}:00"
-        elif len(time) == 2 and time.isdigit() and 0 <= int(time) <= 23:
-            return f"{time}:00"
-        elif len(time) == 4 and time[0].isdigit() and time[2:4].isdigit() and 0 <= int(time[2:4]) <= 59:
-            if time[1] == '.':
-                return ':'.join(time.split('.'))
-            elif time[1] == ':':
-                return time
-        elif len(time) == 5 and time[0:2].isdigit() and time[3:4].isdigit():
-            if time[2] == '.':
-                time = ':'.join(time.split('.'))
-            if time[2] == ':':
-                if 0 <= int(time[0:2]) <= 23 and 0 <= int(time[3:5]) <= 59:
-                    return time
+        match = TOLAB_TIME.fullmatch(time)
+        if match is not None:
+            hours = int(match.group(1))
+            minutes = int(match.group(2) or 0)
+            if hours <= 23 and minutes <= 59:
+                return f"{hours:02d}:{minutes:02d}"
 
         raise ValueError
 
@@ -449,29 +488,32 @@ as well.\nFor a list of the available commands type /help.', )
                     return day
         raise ValueError
 
-    def ring(self, wave_obj):
+    def ring(self):
         """
         Called with /ring
         """
-        inlab = self.logs.get_log().get_entries_inlab()
+        inlab = self.logs.ensure_fresh().get_entries_inlab()
         if len(inlab) <= 0:
             self.__send_message("Nobody is in lab right now, I cannot ring the bell.")
             return
 
+        if self.wave_obj is None:
+            self.wave_obj = simpleaudio.WaveObject.from_wave_file(self.wave_path)
+
         lofi_player = self.lofi_player.get_player()
         if lofi_player.is_playing():
             lofi_player.stop()
             sleep(1)
-            wave_obj.play()
+            self.wave_obj.play()
             sleep(1)
             lofi_player.play()
         else:
-            wave_obj.play()
+            self.wave_obj.play()
 
         self.__send_message("You rang the bell 🔔 Wait at door 3 until someone comes. 🔔")
 
     def user_is_in_lab(self, uid):
-        inlab = self.logs.get_log().get_entries_inlab()
+        inlab = self.logs.ensure_fresh().get_entries_inlab()
         for username in inlab:
             if username == uid:
                 return True
@@ -482,7 +524,7 @@ as well.\nFor a list of the available commands type /help.', )
         Called with /log
         """
 
-        self.logs.get_log()
+        self.logs.ensure_fresh()
 
         if cmd_days_to_filter is not None and cmd_days_to_filter.isdigit():
             # Command is "/log [number]"
@@ -495,12 +537,12 @@ as well.\nFor a list of the available commands type /help.', )
             days_to_print = 1
 
         days = {}
-        # reversed() doesn't create a copy
-        for line in reversed(self.logs.log):
+        log = self.logs.log
+        # Newest lines first, and only the ones we need
+        for index in range(len(log) - 1, self.logs.first_line_of_last_days(days_to_print) - 1, -1):
+            line = log[index]
             this_day = line.day()
             if this_day not in days:
-                if len(days) >= days_to_print:
-                    break
                 days[this_day] = []
 
             print_name = CommandHandler.try_get_display_name(line.username, self.people.get(line.username, self.conn))
@@ -510,12 +552,14 @@ as well.\nFor a list of the available commands type /help.', )
             else:
                 days[this_day].append(f'<i>{print_name}</i>: {escape_all(line.text)}\n')
 
-        msg = ''
+        msg = []
         for this_day in days:
-            msg += '<b>{day}</b>\n{rows}\n'.format(day=this_day, rows=''.join(days[this_day]))
+            msg.append(f'<b>{this_day}</b>\n')
+            msg.extend(days[this_day])
+            msg.append('\n')
 
-        msg = msg + 'Latest log update: <b>{}</b>'.format(self.logs.log_last_update)
-        self.__send_message(msg)
+        msg.append(f'Latest log update: <b>{self.logs.log_last_update}</b>')
+        self.__send_message(''.join(msg))
 
     def stat(self, cmd_target_user=None):
         if cmd_target_user is None:
@@ -541,8 +585,7 @@ as well.\nFor a list of the available commands type /help.', )
         # Do we know what to search?
         if target_username is not None:
             # Downloads them only if needed
-            self.logs.get_old_logs()
-            self.logs.get_log()
+            self.logs.ensure_fresh(old_logs=True)
 
             month_mins, total_mins = self.logs.count_time_user(target_username)
             month_mins_hh, month_mins_mm = self.logs.mm_to_hh_mm(month_mins)
@@ -569,37 +612,32 @@ as well.\nFor a list of the available commands type /help.', )
                 limit = 50
         try:
             history = self.tarallo.get_history(item, limit)
-            msg = f'<b>History of item {item}</b>\n\n'
+            msg = [f'<b>History of item {item}</b>\n\n']
+            length = len(msg[0])
             entries = 0
-            for index in range(0, len(history)):
-                history: List[AuditEntry]
-                change = history[index].change
-                h_user = history[index].user
-                h_other = history[index].other
-                h_time = datetime.datetime.fromtimestamp(int(history[index].time)).strftime('%d-%m-%Y %H:%M')
-                if change == AuditChanges.Move:
-                    msg += f'➡️ Moved to <b>{h_other}</b>\n'
-                elif change == AuditChanges.Update:
-                    msg += '🛠️ Updated features\n'
-                elif change == AuditChanges.Create:
-                    msg += '📋 Created\n'
-                elif change == AuditChanges.Rename:
-                    msg += f'✏️ Renamed from <b>{h_other}</b>\n'
-                elif change == AuditChanges.Delete:
-                    msg += '❌ Deleted\n'
-                elif change == AuditChanges.Lose:
-                    msg += '🔍 Lost\n'
+            entry: AuditEntry
+            for entry in history:
+                h_user = entry.user
+                h_time = f'{datetime.datetime.fromtimestamp(int(entry.time)):%d-%m-%Y %H:%M}'
+                what = HISTORY_CHANGES.get(entry.change)
+                if what is None:
+                    what = f'Unknown change {entry.change.value}'
                 else:
-                    msg += f'Unknown change {change.value}'
-                entries += 1
+                    what = what.format(other=entry.other)
                 display_user = CommandHandler.try_get_display_name(h_user, self.people.get(h_user, self.conn))
-                msg += f'{h_time} by <i>{display_user}</i>\n\n'
-                if entries >= 6:
-                    self.__send_message(msg)
-                    msg = ''
+                when = f'{h_time} by <i>{display_user}</i>\n\n'
+                # Fill each message as much as possible, with some headroom below Telegram's 4096 characters limit
+                if entries > 0 and length + len(what) + len(when) > 3800:
+                    self.__send_message(''.join(msg))
+                    msg = []
+                    length = 0
                     entries = 0
+                msg.append(what)
+                msg.append(when)
+                length += len(what) + len(when)
+                entries += 1
             if entries != 0:
-                self.__send_message(msg)
+                self.__send_message(''.join(msg))
         except ItemNotFoundError:
             self.__send_message(f'Item {item} not found.')
         except AuthenticationError:
@@ -632,18 +670,17 @@ as well.\nFor a list of the available commands type /help.', )
         """
         if self.user.isadmin:
             # Downloads them only if needed
-            self.logs.get_old_logs()
-            self.logs.get_log()
+            self.logs.ensure_fresh(old_logs=True)
 
             # TODO: add something like "/top 04 2018" that returns top list for April 2018
             if cmd_filter == "all":
-                msg = 'Top User List!\n'
+                msg = ['Top User List!\n']
                 rank = self.logs.count_time_all()
             else:
-                msg = 'Top Monthly User List!\n'
+                msg = ['Top Monthly User List!\n']
                 rank = self.logs.count_time_month()
             # sort the dict by value in descending order (and convert dict to list of tuples)
-            rank = sorted(rank.items(), key=lambda x: x[1], reverse=True)
+            rank = sorted(rank.items(), key=itemgetter(1), reverse=True)
 
             n = 0
             for (rival, time) in rank:
@@ -651,14 +688,14 @@ as well.\nFor a list of the available commands type /help.', )
                 if entry is not None:
                     n += 1
                     time_hh, time_mm = self.logs.mm_to_hh_mm(time)
-                    display_user = CommandHandler.try_get_display_name(rival, self.people.get(rival, self.conn))
+                    display_user = CommandHandler.try_get_display_name(rival, entry)
                     if entry.isadmin:
-                        msg += f'{n}) [{time_hh}:{time_mm}] <b>{display_user}</b>\n'
+                        msg.append(f'{n}) [{time_hh}:{time_mm}] <b>{display_user}</b>\n')
                     else:
-                        msg += f'{n}) [{time_hh}:{time_mm}] {display_user}\n'
+                        msg.append(f'{n}) [{time_hh}:{time_mm}] {display_user}\n')
 
-            msg += f'\nLast log update: {self.logs.log_last_update}'
-            self.__send_message(msg)
+            msg.append(f'\nLast log update: {self.logs.log_last_update}')
+            self.__send_message(''.join(msg))
         else:
             self.__send_message('Sorry, only admins can use this function!')
 
@@ -726,16 +763,9 @@ as well.\nFor a list of the available commands type /help.', )
     @staticmethod
     def lofi_keyboard(playing: bool):
         if playing:
-            first_line_button = [inline_keyboard_button("⏸ Pause", callback_data=AcceptableQueriesLoFi.pause.value)]
+            return LOFI_KEYBOARD_PLAYING
         else:
-            first_line_button = [inline_keyboard_button("▶️ Play", callback_data=AcceptableQueriesLoFi.play.value)]
-        reply_markup = [
-            first_line_button,
-            [inline_keyboard_button("🔉 Vol-", callback_data=AcceptableQueriesLoFi.volume_down.value),
-             inline_keyboard_button("🔊 Vol+", callback_data=AcceptableQueriesLoFi.volume_plus.value)],
-            [inline_keyboard_button("❌ Close", callback_data=AcceptableQueriesLoFi.close.value)]
-        ]
-        return reply_markup
+            return LOFI_KEYBOARD_STOPPED
 
     def lofi_callback(self, query: str, messge_id: int):
         lofi_player = self.lofi_player.get_player()
@@ -821,7 +851,8 @@ as well.\nFor a list of the available commands type /help.', )
             username = words[0]
 
             logout_message = ""
-            for word in words[1:]:
+            # The last word may be the rest of the message, with all its spaces
+            for word in " ".join(words[1:]).split():
                 logout_message += word + " "
             logout_message.rstrip().replace("  ", " ")
 
@@ -838,10 +869,7 @@ as well.\nFor a list of the available commands type /help.', )
 
             # send commands
             # TODO: cannot concatenate list only str
-            print(ssh_command[0])
-            print(ssh_command[1])
-            print(username)
-            print(logout_message)
+            logger.debug("Logout: %s%s%s%s", ssh_command[0], username, ssh_command[1], logout_message)
             command = ssh_command[0] + username + ssh_command[1] + '"' + logout_message + '"'
             ssh_connection = SSHUtil(username=SSH_USER,
                                      host=SSH_HOST_IP,
@@ -902,7 +930,13 @@ Note: the logout message cannot contain double quotes characters such as " """
         self.__send_message(help_message)
 
     def help(self):
-        help_message = """Available commands and options:
+        if self.user.isadmin:
+            self.__send_message(HELP_ADMIN)
+        else:
+            self.__send_message(HELP_USER)
+
+
+HELP_USER = """Available commands and options:
 /inlab - Show the people in lab
 /log - Show log of the day
 /log <i>n</i> - Show last <i>n</i> days worth of logs
@@ -912,8 +946,7 @@ Note: the logout message cannot contain double quotes characters such as " """
 /history <i>item</i> <i>n</i> - Show <i>n</i> history entries
 /lofi - Spawns a keyboard with media controls for the lofi YouTube stream"""
 
-        if self.user.isadmin:
-            help_message += """
+HELP_ADMIN = HELP_USER + """
 \n<b>only for admin users</b>
 /stat <i>username</i> - Show hours spent in lab by this user
 /top - Show a list of top users by hours spent this month
@@ -921,165 +954,141 @@ Note: the logout message cannot contain double quotes characters such as " """
 /deletecache - Delete caches (reload logs and users)
 /logout <i>username</i> <i>description of what they've done</i> - Logout a user with weeelab
 /wol - Spawns a keyboard with machines an admin can Wake On LAN"""
-        self.__send_message(help_message)
+
+BOT_SUFFIX = "@weeelab_bot"
+
+# Command => function called with the handler and the command arguments (the other words in the message)
+COMMANDS = {
+    "/start": lambda handler, args: handler.start(),
+    "/inlab": lambda handler, args: handler.inlab(),
+    "/history": lambda handler, args: handler.history(*args[:2]) if args else handler.item_command_error('history'),
+    "/item": lambda handler, args: handler.item_info(args[0]) if args else handler.item_command_error('item'),
+    "/log": lambda handler, args: handler.log(*args[:1]),
+    "/tolab": lambda handler, args: handler.tolab(*args[:2]) if args else handler.tolab_help(),
+    "/ring": lambda handler, args: handler.ring(),
+    "/stat": lambda handler, args: handler.stat(*args[:1]),
+    "/top": lambda handler, args: handler.top(*args[:1]),
+    "/deletecache": lambda handler, args: handler.delete_cache(),
+    "/help": lambda handler, args: handler.help(),
+    "/lofi": lambda handler, args: handler.lofi(),
+    "/wol": lambda handler, args: handler.wol(),
+    # Logout may take minutes if the machine has to be woken up, don't block everything else
+    "/logout": lambda handler, args: Thread(target=handler.logout, args=(args,)).start() if args else handler.logout_help(),
+}
 
 
 def main():
     """main function of the bot"""
-    print("Entered main")
+    logging.basicConfig(level=LOGGING_LEVEL)
+    logger.info("Entered main")
     oc = owncloud.Client(OC_URL)
     oc.login(OC_USER, OC_PWD)
 
     bot = BotHandler(TOKEN_BOT)
     tarallo = Tarallo(TARALLO, TARALLO_TOKEN)
-    logs = WeeelabLogs(oc, LOG_PATH, LOG_BASE, USER_BOT_PATH)
+    logs = WeeelabLogs(oc, LOG_PATH, LOG_BASE, USER_BOT_PATH, OLD_LOGS_CACHE)
     tolab = ToLab(oc, TOLAB_PATH)
     if os.path.isfile("weeedong.wav"):
-        wave_obj = simpleaudio.WaveObject.from_wave_file("weeedong.wav")
+        wave_path = "weeedong.wav"
     else:
-        wave_obj = simpleaudio.WaveObject.from_wave_file("weeedong_default.wav")
-    users = Users(LDAP_ADMIN_GROUPS, LDAP_TREE_PEOPLE, LDAP_TREE_INVITES)
+        wave_path = "weeedong_default.wav"
+    users = Users(LDAP_ADMIN_GROUPS, LDAP_TREE_PEOPLE, LDAP_TREE_INVITES, MAX_CACHED_USERS, USERS_CACHE_TTL,
+                  UNKNOWN_USERS_TTL)
     people = People(LDAP_ADMIN_GROUPS, LDAP_TREE_PEOPLE)
-    conn = LdapConnection(LDAP_SERVER, LDAP_USER, LDAP_PASS)
+    conn = LdapConnection(LDAP_SERVER, LDAP_USER, LDAP_PASS, LDAP_POOL_SIZE)
     wol = WOL_MACHINES
 
-    handler = CommandHandler(bot, tarallo, logs, tolab, users, people, conn, wol)
+    handler = CommandHandler(bot, tarallo, logs, tolab, users, people, conn, wol, wave_path)
+
+    # Handlers run one at a time on this thread, while the main thread goes back to polling right away
+    dispatcher = ThreadPoolExecutor(max_workers=1)
 
     while True:
         # call the function to check if there are new messages
-        last_update = bot.get_last_update()
+        updates = bot.get_updates()
 
-        if last_update == -1:
+        if not updates:
             # When no messages are received...
-            # print("last_update = -1")
             continue
 
-        # per Telegram docs, either message or callback_query are None
-        # noinspection PyBroadException
-        try:
-            if "channel_post" in last_update:
-                # Leave scam channels where people add our bot randomly
-                chat_id = last_update['channel_post']['chat']['id']
-                print(bot.leave_chat(chat_id).text)
-            elif 'message' in last_update:
-                # Handle private messages
-                command = last_update['message']['text'].split()
-                message_type = last_update['message']['chat']['type']
-                # print(last_update['message'])  # Extremely advanced debug techniques
-
-                # Don't respond to messages in group chats
-                if message_type != "private":
-                    continue
-
-                authorized = handler.read_user_from_message(last_update)
-                if not authorized:
-                    continue
-
-                if command[0] == "/start" or command[0] == "/start@weeelab_bot":
-                    handler.start()
-
-                elif command[0] == "/inlab" or command[0] == "/inlab@weeelab_bot":
-                    handler.inlab()
-
-                elif command[0] == "/history" or command[0] == "/history@weeelab_bot":
-                    if len(command) < 2:
-                        handler.item_command_error('history')
-                    elif len(command) < 3:
-                        handler.history(command[1])
-                    else:
-                        handler.history(command[1], command[2])
+        for last_update in updates:
+            dispatcher.submit(handle_update, bot, handler, last_update)
 
-                elif command[0] == "/item" or command[0] == "/item@weeelab_bot":
-                    if len(command) < 2:
-                        handler.item_command_error('item')
-                    else:
-                        handler.item_info(command[1])
 
-                elif command[0] == "/log" or command[0] == "/log@weeelab_bot":
-                    if len(command) > 1:
-                        handler.log(command[1])
-                    else:
-                        handler.log()
-
-                elif command[0] == "/tolab" or command[0] == "/tolab@weeelab_bot":
-                    if len(command) == 2:
-                        handler.tolab(command[1])
-                    elif len(command) >= 3:
-                        handler.tolab(command[1], command[2])
-                    else:
-                        handler.tolab_help()
-
-                elif command[0] == "/ring":
-                    handler.ring(wave_obj)
-
-                elif command[0] == "/stat" or command[0] == "/stat@weeelab_bot":
-                    if len(command) > 1:
-                        handler.stat(command[1])
-                    else:
-                        handler.stat()
-
-                elif command[0] == "/top" or command[0] == "/top@weeelab_bot":
-                    if len(command) > 1:
-                        handler.top(command[1])
-                    else:
-                        handler.top()
-
-                elif command[0] == "/deletecache" or command[0] == "/deletecache@weeelab_bot":
-                    handler.delete_cache()
-
-                elif command[0] == "/help" or command[0] == "/help@weeelab_bot":
-                    handler.help()
-
-                elif command[0] == "/lofi" or command[0] == "/lofi@weeelab_bot":
-                    handler.lofi()
+def handle_update(bot: BotHandler, handler: CommandHandler, last_update):
+    """Handle a single update (message, button press, etc...) received from Telegram"""
+    # per Telegram docs, either message or callback_query are None
+    # noinspection PyBroadException
+    try:
+        # Each update has only one of these
+        channel_post = last_update.get('channel_post')
+        message = last_update.get('message')
+        callback_query = last_update.get('callback_query')
+        if channel_post is not None:
+            # Leave scam channels where people add our bot randomly
+            chat_id = channel_post['chat']['id']
+            logger.info("Leaving channel %d", chat_id)
+            bot.leave_chat(chat_id)
+        elif message is not None:
+            # Handle private messages
+            logger.debug("Message: %s", message)  # Extremely advanced debug techniques
+
+            # Don't respond to messages in group chats
+            if message['chat']['type'] != "private":
+                return
 
-                elif command[0] == "/wol" or command[0] == "/wol@weeelab_bot":
-                    handler.wol()
+            authorized = handler.read_user_from_message(message)
+            if not authorized:
+                return
 
-                elif command[0] == "/logout" or command[0] == "/logout@weeelab_bot":
-                    if len(command) > 1:
-                        # handler.logout(command[1:])
-                        logout = Thread(target=handler.logout, args=(command[1:],))
-                        logout.start()
-                    else:
-                        handler.logout_help()
+            # Photos, stickers and so on have no text
+            text = message.get('text')
+            if text is None or not text.startswith('/'):
+                handler.unknown()
+                return
 
-                else:
-                    handler.unknown()
+            # No command takes more than 2 arguments, except for the logout message which is kept whole as the last one
+            command = text.split(None, 3)
+            name = command[0]
+            if name.endswith(BOT_SUFFIX):
+                name = name[:-len(BOT_SUFFIX)]
+            action = COMMANDS.get(name)
+            if action is None:
+                handler.unknown()
+            else:
+                action(handler, command[1:])
 
-            elif 'callback_query' in last_update:
-                authorized = handler.read_user_from_callback(last_update)
-                if not authorized:
-                    continue
+        elif callback_query is not None:
+            authorized = handler.read_user_from_callback(callback_query)
+            if not authorized:
+                return
 
-                # Handle button callbacks
-                query = last_update['callback_query']['data']
-                message_id = last_update['callback_query']['message']['message_id']
+            # Handle button callbacks
+            query = callback_query['data']
+            message_id = callback_query['message']['message_id']
 
-                if query.startswith('wol_'):
-                    handler.wol_callback(query, message_id)
-                elif query.startswith('lofi_'):
-                    handler.lofi_callback(query, message_id)
-                else:
-                    handler.unknown()
+            if query.startswith('wol_'):
+                handler.wol_callback(query, message_id)
+            elif query.startswith('lofi_'):
+                handler.lofi_callback(query, message_id)
             else:
-                print('Unsupported "last_update" type')
-                print(last_update)
+                handler.unknown()
+        else:
+            logger.warning('Unsupported "last_update" type: %s', last_update)
 
-        except:  # catch any exception if raised
-            print("ERROR!")
-            print(last_update)
-            print(traceback.format_exc())
+    except Exception:  # catch any exception if raised, the executor would hide it otherwise
+        logger.exception("ERROR! %s", last_update)
 
 
 # call the main() until a keyboard interrupt is called
 if __name__ == '__main__':
+    # Restarting is up to whoever runs the bot (Restart=on-failure in bot.service), a fresh process doesn't leak
+    # threads and connections from the one that crashed
     # noinspection PyBroadException
     try:
         main()
     except KeyboardInterrupt:
         exit()
-    except:
-        print("MEGAERROR!")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("MEGAERROR!")
         exit(1)